@@ -51,7 +51,8 @@ def main(argv):
             'env': {}
         }, interval=sleep_interval)
 
-    # Download HI4PI
+    # Download HI4PI and generate miriad bash script (run in one helper container)
+    helper_commands = []
     logger.info('HI4PI download')
     hi4pi_image = os.path.join(workdir, config['hi4pi']['filename'])
     vizier_width = float(config['hi4pi']['vizier_query_width'])
@@ -59,32 +60,35 @@ def main(argv):
         client.isfile(path_to_vos(hi4pi_image))
         logger.info(f'HI4PI image {hi4pi_image} already exists. Skipping step')
     except:
-        job('hi4pi_download', {
-            'name': "hi4pi-download",
-            'image': config['hi4pi']['image'],
-            'cores': 1,
-            'ram': 4,
-            'kind': "headless",
-            'cmd': 'python3',
-            'args': f"{config['hi4pi']['script']} -i {image} -o {hi4pi_image} -w {vizier_width}",
-            'env': {}
-        }, interval=sleep_interval)
+        helper_commands.append(f"hi4pi-download -i {image} -o {hi4pi_image} -w {vizier_width}")
 
-    # Generate miriad bash script
     logger.info('Generate miriad bash script')
     miriad_script = os.path.join(workdir, config['miriad_script']['output_filename'])
+    intermediate_args = ''
+    if config['miriad_script'].get('scratch'):
+        intermediate_args += f" -s {config['miriad_script']['scratch']}"
+    if config['miriad_script'].getboolean('cleanup', fallback=False):
+        intermediate_args += ' -c'
+    spectral_args = ''
+    if config['miriad_script'].get('velocity_range'):
+        spectral_args = f" --velocity_range={config['miriad_script']['velocity_range']}"
+    elif config['miriad_script'].get('wallaby_spectral_range'):
+        spectral_args = f" -cw {config['miriad_script']['wallaby_spectral_range']}"
     try:
         client.isfile(path_to_vos(miriad_script))
         logger.info('Miriad script exists. Skipping step')
     except:
-        job('miraid_script', {
-            'name': "miriad-script",
-            'image': config['miriad_script']['image'],
+        helper_commands.append(f"miriad-script -wd {workdir} -f {miriad_script} -o {os.path.join(workdir, config['miriad_script']['combination_filename'])} -w {subfits_image} -sd {hi4pi_image} -r {config['miriad_script']['region']}{spectral_args}{intermediate_args}")
+
+    if helper_commands:
+        job('helpers', {
+            'name': "helpers",
+            'image': config['helpers']['image'],
             'cores': 1,
             'ram': 4,
             'kind': "headless",
             'cmd': 'python3',
-            'args': f"{config['miriad_script']['script']} -wd {workdir} -f {os.path.join(workdir, config['miriad_script']['output_filename'])} -o {os.path.join(workdir, config['miriad_script']['combination_filename'])} -w {subfits_image} -sd {os.path.join(workdir, config['hi4pi']['filename'])} -r {config['miriad_script']['region']} -cw {config['miriad_script']['wallaby_spectral_range']}",
+            'args': f"{config['helpers']['script']} {' :: '.join(helper_commands)}",
             'env': {}
         }, interval=sleep_interval)
 
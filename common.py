@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import ssl
 import time
 import json
+import asyncio
+import aiohttp
 import requests
 from prefect import task, flow, get_run_logger
 
@@ -13,6 +17,103 @@ CANFAR_SESSION_URL = 'https://ws-uv.canfar.net/skaha/v0/session'
 RUNNING_STATES = ['Pending', 'Running', 'Terminating']
 COMPLETE_STATES = ['Succeeded']
 FAILED_STATES = ['Failed']
+MAX_POLL_FAILURES = 10
+MAX_POLL_INTERVAL = 300
+
+# Session failure classification (matched against session status and logs)
+TRANSIENT = 'transient'
+OOM = 'oom'
+DETERMINISTIC = 'deterministic'
+OOM_PATTERNS = [r'OOMKilled', r'[Oo]ut of memory', r'MemoryError', r'exit code:? 137', r'std::bad_alloc']
+TRANSIENT_PATTERNS = [
+    r'ErrImagePull', r'ImagePullBackOff', r'Evicted', r'NodeLost', r'[Nn]ode .* (not ready|shutdown)',
+    r'Preempt', r'DeadlineExceeded', r'[Cc]onnection (reset|refused|aborted)', r'[Tt]imed? ?out',
+    r'Service Unavailable', r'Bad Gateway', r'Gateway Time-?out'
+]
+
+
+class CanfarSessionError(Exception):
+    """CANFAR session request or job failure with the classified cause
+
+    """
+    def __init__(self, message, cause=DETERMINISTIC, session_id=None):
+        super().__init__(message)
+        self.cause = cause
+        self.session_id = session_id
+
+
+class RetryPolicy(object):
+    """Retry policy for CANFAR sessions. Transient failures are retried with exponential backoff,
+    out of memory failures are resubmitted with RAM multiplied by ram_factor up to max_ram [GB].
+
+    """
+    def __init__(self, max_retries=3, backoff=30.0, max_backoff=600.0, ram_factor=2.0, max_ram=192):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.ram_factor = ram_factor
+        self.max_ram = max_ram
+
+    def delay(self, attempt):
+        return min(self.backoff * 2 ** attempt, self.max_backoff)
+
+    def escalate_ram(self, ram):
+        return min(int(float(ram) * self.ram_factor), self.max_ram)
+
+
+def classify_failure(text='', status_code=None):
+    """Classify a failed session or session request as transient, out of memory or deterministic
+
+    """
+    if status_code is not None and (status_code >= 500 or status_code == 429):
+        return TRANSIENT
+    if any(re.search(p, text) for p in OOM_PATTERNS):
+        return OOM
+    if status_code is None and any(re.search(p, text) for p in TRANSIENT_PATTERNS):
+        return TRANSIENT
+    return DETERMINISTIC
+
+
+def next_attempt(params, error, attempt, policy, history):
+    """Record a failed attempt and return the parameters for the next attempt.
+    Raises the error if it should not be retried.
+
+    """
+    logger = get_run_logger()
+    history.append({'attempt': attempt, 'session': error.session_id, 'cause': error.cause, 'ram': params.get('ram')})
+    logger.warning(f'Attempt {attempt} failed ({error.cause}): {history}')
+    if error.cause == DETERMINISTIC or attempt >= policy.max_retries:
+        raise error
+    if error.cause == OOM:
+        ram = policy.escalate_ram(params['ram'])
+        if ram <= int(params['ram']):
+            raise error
+        logger.info(f'Resubmitting with RAM {params["ram"]} -> {ram} GB')
+        params = {**params, 'ram': ram}
+    return params
+
+
+def poll_delay(interval, failures):
+    """Delay [s] before the next status request after consecutive failed status requests
+
+    """
+    return min(interval * 2 ** failures, max(interval, MAX_POLL_INTERVAL))
+
+
+def abandoned_session_error(id, failures, deleted):
+    """Error for a session whose status could not be retrieved. Only a session confirmed
+    deleted is safe to resubmit, otherwise it may still be running.
+
+    """
+    if deleted:
+        return CanfarSessionError(
+            f'Session {id} status unavailable after {failures} requests, session deleted',
+            cause=TRANSIENT, session_id=id
+        )
+    return CanfarSessionError(
+        f'Session {id} status unavailable after {failures} requests and the session could not be deleted, not resubmitting',
+        cause=DETERMINISTIC, session_id=id
+    )
 
 
 def path_to_vos(path):
@@ -37,10 +138,13 @@ def create_canfar_session(params):
     logger = get_run_logger()
     cert = os.getenv('CADC_CERTIFICATE', CADC_DEFAULT_CERTIFICATE)
 
-    r = requests.post(CANFAR_SESSION_URL, data=params, cert=cert)
+    try:
+        r = requests.post(CANFAR_SESSION_URL, data=params, cert=cert)
+    except requests.exceptions.RequestException as e:
+        raise CanfarSessionError(f'Request failed {e}', cause=TRANSIENT)
     if r.status_code != 200:
         logger.error(r.status_code)
-        raise Exception(f'Request failed {r.content}')
+        raise CanfarSessionError(f'Request failed {r.content}', cause=classify_failure(r.text, r.status_code))
     return r.content.decode('utf-8')
 
 
@@ -58,35 +162,304 @@ def info_canfar_session(id, logs=False):
     return r
 
 
-@task(task_run_name='{name}')
-def job(name, params, interval=10, *args, **kwargs):
-    """Job wrapper for CANFAR containers
+def delete_canfar_session(id, interval=10, attempts=MAX_POLL_FAILURES):
+    """Delete a CANFAR session and confirm it no longer exists. Returns True if the session is gone.
+
+    """
+    logger = get_run_logger()
+    cert = os.getenv('CADC_CERTIFICATE', CADC_DEFAULT_CERTIFICATE)
+
+    url = f'{CANFAR_SESSION_URL}/{id}'
+    try:
+        r = requests.delete(url, cert=cert)
+        if r.status_code not in [200, 204, 404]:
+            logger.error(f'Delete session {id} failed {r.status_code} {r.content}')
+            return False
+        for _ in range(attempts):
+            if requests.get(url, cert=cert).status_code == 404:
+                return True
+            time.sleep(interval)
+    except requests.exceptions.RequestException as e:
+        logger.exception(e)
+    return False
+
+
+def canfar_session_logs(id):
+    """Session logs, or an empty string if they cannot be retrieved
+
+    """
+    logger = get_run_logger()
+    try:
+        return info_canfar_session(id, logs=True).text
+    except requests.exceptions.RequestException as e:
+        logger.exception(e)
+        return ''
+
+
+def run_canfar_session(params, interval=10, max_poll_failures=MAX_POLL_FAILURES):
+    """Create a CANFAR session and wait for it to complete. Returns the session id and logs.
+    Failed status requests are retried with backoff. After max_poll_failures in a row the session
+    is deleted, and only a session confirmed deleted raises a transient (retryable) CanfarSessionError.
 
     """
     logger = get_run_logger()
-    logger.info(name)
     completed = False
+    failures = 0
     session_id = create_canfar_session(params).strip('\n')
     logger.info(f'Session: {session_id}')
     while not completed:
-        res = info_canfar_session(session_id, logs=False)
         try:
+            res = info_canfar_session(session_id, logs=False)
             status = json.loads(res.text)['status']
+            failures = 0
         except Exception as e:
             logger.exception(e)
+            failures += 1
+            if failures >= max_poll_failures:
+                deleted = delete_canfar_session(session_id, interval=interval)
+                raise abandoned_session_error(session_id, failures, deleted)
+            time.sleep(poll_delay(interval, failures))
             continue
 
         completed = status in COMPLETE_STATES
         failed = status in FAILED_STATES
         if failed:
-            logs = info_canfar_session(session_id, logs=True)
-            logger.error(logs.content)
-            raise Exception(f'Job failed {logs.text}')
+            logs = canfar_session_logs(session_id)
+            logger.error(logs)
+            cause = classify_failure(f'{res.text}\n{logs}')
+            raise CanfarSessionError(f'Job failed {logs}', cause=cause, session_id=session_id)
 
         time.sleep(interval)
         logger.info(f'Job {session_id} {status}')
 
+    return session_id, canfar_session_logs(session_id)
+
+
+@task(task_run_name='{name}')
+def job(name, params, interval=10, retry=None, *args, **kwargs):
+    """Job wrapper for CANFAR containers. Returns the history of failed attempts.
+
+    """
+    logger = get_run_logger()
+    logger.info(name)
+    retry = retry or RetryPolicy()
+    history = []
+    attempt = 0
+    while True:
+        try:
+            session_id, logs = run_canfar_session(params, interval=interval)
+            break
+        except CanfarSessionError as e:
+            params = next_attempt(params, e, attempt, retry, history)
+            time.sleep(retry.delay(attempt))
+            attempt += 1
+
     # Logging to stdout
-    res = info_canfar_session(session_id, logs=True)
-    logger.info(res.text)
-    return
\ No newline at end of file
+    logger.info(logs)
+    if history:
+        logger.info(f'Job {name} succeeded after {len(history)} retries: {history}')
+    return history
+
+
+def _session_form(params):
+    """Encode session parameters as form fields (dictionary values as key=value entries)
+
+    """
+    form = []
+    for key, value in params.items():
+        if isinstance(value, dict):
+            form += [(key, f'{k}={v}') for k, v in value.items()]
+        else:
+            form.append((key, str(value)))
+    return form
+
+
+class SkahaClient(object):
+    """Asynchronous Skaha API client for supervising many concurrent CANFAR sessions from one event loop.
+    The number of sessions in flight is limited by max_sessions, and the status of all sessions being
+    waited on is updated with a single session list request per poll interval.
+
+    """
+    def __init__(self, cert=None, max_sessions=100, interval=10, max_poll_failures=MAX_POLL_FAILURES):
+        self.cert = cert or os.getenv('CADC_CERTIFICATE', CADC_DEFAULT_CERTIFICATE)
+        self.interval = interval
+        self.max_poll_failures = max_poll_failures
+        self.semaphore = asyncio.Semaphore(max_sessions)
+        self._session = None
+        self._waiters = {}
+        self._poller = None
+
+    async def __aenter__(self):
+        ssl_context = ssl.create_default_context()
+        ssl_context.load_cert_chain(self.cert)
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_context))
+        return self
+
+    async def __aexit__(self, *exc):
+        if self._poller is not None:
+            self._poller.cancel()
+        await self._session.close()
+
+    async def create_session(self, params):
+        async with self._session.post(CANFAR_SESSION_URL, data=_session_form(params)) as r:
+            content = await r.text()
+            if r.status != 200:
+                raise CanfarSessionError(f'Request failed {r.status} {content}', cause=classify_failure(content, r.status))
+        return content.strip('\n')
+
+    async def info_session(self, id, logs=False):
+        url = f'{CANFAR_SESSION_URL}/{id}'
+        if logs:
+            url = f'{url}?view=logs'
+        async with self._session.get(url) as r:
+            return r.status, await r.text()
+
+    async def list_sessions(self):
+        """Status of all sessions for the user in a single request
+
+        """
+        async with self._session.get(CANFAR_SESSION_URL) as r:
+            r.raise_for_status()
+            sessions = json.loads(await r.text())
+        return {s['id']: s['status'] for s in sessions}
+
+    def _resolve(self, id, status=None, exception=None):
+        future = self._waiters.pop(id, None)
+        if future is None or future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(status)
+
+    async def delete_session(self, id):
+        """Delete a session and confirm it no longer exists. Returns True if the session is gone.
+
+        """
+        url = f'{CANFAR_SESSION_URL}/{id}'
+        try:
+            async with self._session.delete(url) as r:
+                if r.status not in [200, 204, 404]:
+                    get_run_logger().error(f'Delete session {id} failed {r.status} {await r.text()}')
+                    return False
+            for _ in range(self.max_poll_failures):
+                code, _ = await self.info_session(id)
+                if code == 404:
+                    return True
+                await asyncio.sleep(self.interval)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            get_run_logger().exception(e)
+        return False
+
+    async def _lookup(self, id):
+        """Status of a session missing from the session list (None if not available)
+
+        """
+        try:
+            code, content = await self.info_session(id)
+            if code == 200:
+                return json.loads(content)['status']
+        except Exception as e:
+            get_run_logger().exception(e)
+        return None
+
+    async def _poll(self):
+        """Update the status of all waited on sessions. Sessions missing from the session list, or all
+        sessions if the list request fails, are looked up individually, and the poll interval backs off
+        while the list request keeps failing. A session without status for max_poll_failures polls in
+        a row is deleted, and only resubmitted (transient failure) if confirmed deleted.
+
+        """
+        logger = get_run_logger()
+        list_failures = 0
+        failures = {}
+        try:
+            while self._waiters:
+                await asyncio.sleep(poll_delay(self.interval, list_failures))
+                try:
+                    statuses = await self.list_sessions()
+                    list_failures = 0
+                except Exception as e:
+                    logger.exception(e)
+                    statuses = {}
+                    list_failures += 1
+                for id in list(self._waiters.keys()):
+                    status = statuses.get(id)
+                    if status is None:
+                        status = await self._lookup(id)
+                    if status is None:
+                        failures[id] = failures.get(id, 0) + 1
+                        if failures[id] >= self.max_poll_failures:
+                            deleted = await self.delete_session(id)
+                            self._resolve(id, exception=abandoned_session_error(id, failures.pop(id), deleted))
+                        continue
+                    failures.pop(id, None)
+                    if status in COMPLETE_STATES or status in FAILED_STATES:
+                        self._resolve(id, status)
+        except Exception as e:
+            for id in list(self._waiters.keys()):
+                self._resolve(id, exception=e)
+        finally:
+            self._poller = None
+
+    async def wait(self, id):
+        """Wait for a session to reach a completed or failed state
+
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[id] = future
+        if self._poller is None:
+            self._poller = asyncio.create_task(self._poll())
+        return await future
+
+    async def run(self, params):
+        """Create a session and wait for it to finish.
+        Returns the session id, final status, session info (for failed sessions) and logs.
+
+        """
+        async with self.semaphore:
+            try:
+                session_id = await self.create_session(params)
+            except aiohttp.ClientError as e:
+                raise CanfarSessionError(f'Request failed {e}', cause=TRANSIENT)
+            status = await self.wait(session_id)
+            info = ''
+            try:
+                if status in FAILED_STATES:
+                    _, info = await self.info_session(session_id)
+                _, logs = await self.info_session(session_id, logs=True)
+            except aiohttp.ClientError as e:
+                get_run_logger().exception(e)
+                logs = ''
+        return session_id, status, info, logs
+
+
+@task(task_run_name='{name}')
+async def job_async(name, params, client, retry=None, *args, **kwargs):
+    """Asynchronous job wrapper for CANFAR containers run through a shared SkahaClient.
+    Returns the history of failed attempts.
+
+    """
+    logger = get_run_logger()
+    logger.info(name)
+    retry = retry or RetryPolicy()
+    history = []
+    attempt = 0
+    while True:
+        try:
+            session_id, status, info, logs = await client.run(params)
+            logger.info(f'Job {session_id} {status}')
+            if status in FAILED_STATES:
+                logger.error(logs)
+                cause = classify_failure(f'{info}\n{logs}')
+                raise CanfarSessionError(f'Job failed {logs}', cause=cause, session_id=session_id)
+            break
+        except CanfarSessionError as e:
+            params = next_attempt(params, e, attempt, retry, history)
+            await asyncio.sleep(retry.delay(attempt))
+            attempt += 1
+
+    logger.info(logs)
+    if history:
+        logger.info(f'Job {name} succeeded after {len(history)} retries: {history}')
+    return history
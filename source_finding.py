@@ -2,6 +2,9 @@
 
 import os
 import sys
+import json
+import asyncio
+import tempfile
 from argparse import ArgumentParser
 from configparser import ConfigParser
 from prefect import flow, get_run_logger
@@ -9,8 +12,24 @@ from vos import Client
 from common import *
 
 
+@flow(name='wallaby-mw-sofia-slabs')
+async def sofia_slabs(jobs, max_sessions=100, interval=10):
+    """Run SoFiA sessions for all spectral slabs concurrently from one event loop.
+    Waits for every slab to finish before raising an error for the slabs that failed.
+
+    """
+    logger = get_run_logger()
+    async with SkahaClient(max_sessions=max_sessions, interval=interval) as client:
+        results = await asyncio.gather(*[job_async(name, params, client) for name, params in jobs], return_exceptions=True)
+    failed = {name: res for (name, _), res in zip(jobs, results) if isinstance(res, BaseException)}
+    for name, e in failed.items():
+        logger.error(f'{name} failed: {e}')
+    if failed:
+        raise Exception(f'SoFiA failed for {len(failed)} of {len(jobs)} slabs: {", ".join(failed.keys())}')
+
+
 @flow(name='wallaby-mw-source-finding-pipeline')
-def main(argv):
+async def main(argv):
     logger = get_run_logger()
     client = Client()
 
@@ -35,44 +54,36 @@ def main(argv):
 
     # sofia parameter files
     logger.info('Generating sofia parameter files')
+    manifest = os.path.join(workdir, config['sofia']['slab_manifest'])
     job('sofia-config-mw', {
         'name': "sofia-config-mw",
-        'image': config['sofia']['sofia_config_mw_image'],
+        'image': config['helpers']['image'],
         'cores': 1,
         'ram': 4,
         'kind': "headless",
         'cmd': 'python3',
-        'args': f"/app/update_sofia_config.py --image={config['sofia']['image']} --input_parameter_file={config['sofia']['parameter_file']} --output_parameter_files={config['pipeline']['workdir']} --input_data={config['sofia']['image']} --output_directory={workdir}",
-        'env': {}
-    }, interval=sleep_interval)
-
-    # SoFiA negative velocity range
-    logger.info('SoFiA negative velocity range')
-    neg_par = os.path.join(workdir, config['sofia']['negative_parameter_file'])
-    job('sofia-neg', {
-        'name': "sofia-neg",
-        'image': config['sofia']['sofia_image'],
-        'cores': 4,
-        'ram': 32,
-        'kind': "headless",
-        'cmd': 'sofia',
-        'args': neg_par,
+        'args': f"{config['helpers']['script']} sofia-config --image={image} --input_parameter_file={config['sofia']['parameter_file']} --output_parameter_files={workdir} --input_data={image} --output_directory={workdir} --negative_filename={config['sofia']['negative_parameter_file']} --positive_filename={config['sofia']['positive_parameter_file']} --ram={config['sofia']['ram']} --slabs={config['sofia']['slabs']} --tiles={config['sofia'].get('tiles', '1,1')} --manifest={config['sofia']['slab_manifest']}",
         'env': {}
     }, interval=sleep_interval)
 
-    # SoFiA positive velocity range
-    logger.info('SoFiA positive velocity range')
-    pos_par = os.path.join(workdir, config['sofia']['positive_parameter_file'])
-    job('sofia-pos', {
-        'name': "sofia-pos",
+    # SoFiA on each spectral slab in parallel
+    with tempfile.TemporaryDirectory() as tmpdir:
+        local_manifest = os.path.join(tmpdir, os.path.basename(manifest))
+        client.copy(path_to_vos(manifest), local_manifest)
+        with open(local_manifest, 'r') as f:
+            slabs = json.load(f)
+    logger.info(f'SoFiA on {len(slabs)} spectral slabs')
+    await sofia_slabs([(f"sofia-{slab['name']}", {
+        'name': f"sofia-{slab['name']}",
         'image': config['sofia']['sofia_image'],
         'cores': 4,
-        'ram': 32,
+        'ram': slab['ram'],
         'kind': "headless",
         'cmd': 'sofia',
-        'args': pos_par,
+        'args': slab['parameter_file'],
         'env': {}
-    }, interval=sleep_interval)
+    }) for slab in slabs], max_sessions=int(config['pipeline']['max_sessions']), interval=sleep_interval)
+    parameter_files = ' '.join([slab['parameter_file'] for slab in slabs])
 
     # SoFiAX config generation
     logger.info('Updating sofiax config file')
@@ -97,10 +108,10 @@ def main(argv):
         'ram': 16,
         'kind': "headless",
         'cmd': 'python3',
-        'args': f"-m sofiax -c {sofiax_run_config} -p {neg_par} {pos_par}",
+        'args': f"-m sofiax -c {sofiax_run_config} -p {parameter_files}",
         'env': {}
     }, interval=sleep_interval)
 
 
 if __name__ == '__main__':
-    main(sys.argv[1:])
+    asyncio.run(main(sys.argv[1:]))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+"""
+Single entry point for the WALLABY Milky Way helper scripts, so that one container can run
+several helper stages in sequence without paying interpreter and import start-up per stage.
+Subcommands are separated by '::', for example
+
+    python3 /app/wallaby_mw_helper.py hi4pi-download -i <image> -o <hi4pi> :: miriad-script -wd <workdir> ...
+
+Start-up, import and run time of each subcommand is logged. Run with PYTHONPROFILEIMPORTTIME=1
+(or python3 -X importtime) for a per-module breakdown of import time.
+"""
+
+import sys
+import time
+import logging
+import importlib
+
+
+_START = time.perf_counter()
+logging.basicConfig(level=logging.INFO)
+
+SEPARATOR = '::'
+SUBCOMMANDS = {
+    'hi4pi-download': 'download_wallaby_hi4pi',
+    'miriad-script': 'generate_script',
+    'sofia-config': 'update_sofia_config'
+}
+
+
+def split_commands(argv):
+    """Split the command line into a list of (subcommand, argv) at each separator
+
+    """
+    commands = []
+    current = []
+    for arg in argv + [SEPARATOR]:
+        if arg != SEPARATOR:
+            current.append(arg)
+            continue
+        if current:
+            if current[0] not in SUBCOMMANDS:
+                raise SystemExit(f'Unknown subcommand {current[0]}. Choose from: {", ".join(SUBCOMMANDS)}')
+            commands.append((current[0], current[1:]))
+        current = []
+    return commands
+
+
+def main(argv):
+    commands = split_commands(argv)
+    if not commands:
+        raise SystemExit(f'Usage: wallaby_mw_helper.py <subcommand> [args] [{SEPARATOR} <subcommand> [args] ...]\nSubcommands: {", ".join(SUBCOMMANDS)}')
+
+    logging.info(f'Helper start-up: {time.perf_counter() - _START:.3f} s')
+    for name, args in commands:
+        t0 = time.perf_counter()
+        module = importlib.import_module(SUBCOMMANDS[name])
+        t1 = time.perf_counter()
+        module.main(args)
+        t2 = time.perf_counter()
+        logging.info(f'{name}: import {t1 - t0:.3f} s, run {t2 - t1:.3f} s')
+    logging.info(f'Helper total: {time.perf_counter() - _START:.3f} s')
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    main(argv)
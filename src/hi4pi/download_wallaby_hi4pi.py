@@ -8,13 +8,7 @@ Specifically to be used for the generation of WALLABY Milky Way data products
 import os
 import sys
 import time
-import wget
 import logging
-import astropy.units as u
-from astropy.coordinates import SkyCoord
-from astropy.io import fits
-from astropy.wcs import WCS
-from astroquery.vizier import Vizier
 from argparse import ArgumentParser
 from configparser import ConfigParser
 
@@ -25,15 +19,12 @@ URL = 'https://cdsarc.u-strasbg.fr/ftp/J/A+A/594/A116/CUBES/EQ2000/SIN/'
 CATALOG = 'J/A+A/594/A116/cubes_eq'
 
 
-def get_centre(header):
-    w = WCS(header)
-    c_ra_pix = header['NAXIS1'] // 2
-    c_dec_pix = header['NAXIS2'] // 2
-    centre = SkyCoord.from_pixel(c_ra_pix, c_dec_pix, wcs=w)
-    return centre
-
-
 def download_hi4pi(ra, dec, width, url, catalog, output_file):
+    import wget
+    import astropy.units as u
+    from astropy.coordinates import SkyCoord
+    from astroquery.vizier import Vizier
+
     centre = SkyCoord(ra=ra*u.deg, dec=dec*u.deg)
     vizier = Vizier(columns=['*'], catalog=catalog)
     res = vizier.query_region(centre, width=width*u.deg)[0]
@@ -69,15 +60,15 @@ def main(argv):
     assert os.path.exists(args.image), f'WALLABY Milky Way fits file does not exist: {args.image}'
 
     # Open WALLABY observation
+    from astropy.io import fits
+    from footprint import Footprint
     with fits.open(args.image) as hdul:
         header = hdul[0].header
-    centre = get_centre(header)
-    c_ra = centre.ra
-    c_dec = centre.dec
+    c_ra, c_dec = Footprint(header).centre()
     logging.info(f'Centre coordinate: ({c_ra}, {c_dec})')
 
     # Download HI4PI images
-    download_hi4pi(c_ra.value, c_dec.value, args.width, URL, CATALOG, args.output)
+    download_hi4pi(c_ra, c_dec, args.width, URL, CATALOG, args.output)
     logging.info('Download complete')
 
 
@@ -7,34 +7,13 @@ Code to help generate a bash script for running within the miriad container.
 import os
 import sys
 import logging
-from astropy.io import fits
-from astropy.wcs import WCS
-from astropy.coordinates import SkyCoord
-import astropy.units as u
 from argparse import ArgumentParser
 
 
 logging.basicConfig(level=logging.INFO)
 
-
-def get_centre(header):
-    w = WCS(header)
-    c_ra_pix = header['NAXIS1'] // 2
-    c_dec_pix = header['NAXIS2'] // 2
-    centre = SkyCoord.from_pixel(c_ra_pix, c_dec_pix, wcs=w)
-    return centre
-
-
-def wallaby_pixel_region(header, size):
-    """Define the region of the WALLABY cube extract from imsub for miriad single dish combination
-
-    """
-    w = WCS(header)
-    centre = get_centre(header)
-    dr = size // 2 * u.arcmin
-    ra_max, dec_max = SkyCoord(ra=centre.ra - dr, dec=centre.dec + dr).to_pixel(wcs=w)
-    ra_min, dec_min = SkyCoord(ra=centre.ra + dr, dec=centre.dec - dr).to_pixel(wcs=w)
-    return int(ra_min), int(dec_min), int(ra_max), int(dec_max)
+# Miriad datasets only read by later steps of the script
+TRANSIENT_DATASETS = ['sd', 'sd_hann', 'sd_imsub_incr', 'sd_imsub', 'wallaby', 'wallaby_trim', 'sd_regrid', 'combined']
 
 
 def main(argv):
@@ -65,6 +44,20 @@ def main(argv):
         required=False,
         default='42,426'
     )
+    parser.add_argument(
+        '-v',
+        '--velocity_range',
+        help='[Optional] Velocity window vmin,vmax [km/s, radio convention] from which the WALLABY and HI4PI channel ranges are derived',
+        required=False,
+        default=None
+    )
+    parser.add_argument(
+        '-vf',
+        '--velocity_frame',
+        help='[Optional] Spectral reference frame of the velocity window',
+        required=False,
+        default='LSRK'
+    )
     parser.add_argument(
         '-uv',
         '--immerge_uvrange',
@@ -80,6 +73,27 @@ def main(argv):
         type=int,
         default=320
     )
+    parser.add_argument(
+        '-sdr',
+        '--hi4pi_region',
+        help='[Optional] Crop the HI4PI observation to the WALLABY footprint before regridding',
+        required=False,
+        action='store_true'
+    )
+    parser.add_argument(
+        '-s',
+        '--scratch',
+        help='[Optional] Session-local scratch directory for intermediate miriad datasets (default: working directory)',
+        required=False,
+        default=None
+    )
+    parser.add_argument(
+        '-c',
+        '--cleanup',
+        help='[Optional] Remove intermediate miriad datasets once the combined fits file has been written',
+        required=False,
+        action='store_true'
+    )
     args = parser.parse_args(argv)
 
     # Assert exists
@@ -92,39 +106,80 @@ def main(argv):
     if os.path.exists(args.output):
         logging.error(f'Output single-dish WALLABY combination already produced: {args.output}')
 
-    region_str = args.imsub_region
-    if args.imsub_region is None:
+    if args.imsub_region is None or args.hi4pi_region or args.velocity_range is not None:
+        from astropy.io import fits
+        from footprint import Footprint
+        from spectral import SpectralAxis
+
         logging.info('Reading WALLABY fits header for spatial combination region')
         with fits.open(args.wallaby) as hdul:
-            header = hdul[0].header
-            region = wallaby_pixel_region(header, args.size)
-            logging.info(f'WALLABY spatial region: {region}')
-        region_str = str(region).strip('()').replace(' ', '')
+            footprint = Footprint(hdul[0].header)
+            wallaby_spectral = SpectralAxis(hdul[0].header)
+
+    if args.velocity_range is not None:
+        vmin, vmax = [float(v) for v in args.velocity_range.split(',')]
+        ra, dec = footprint.centre()
+        with fits.open(args.singledish) as hdul:
+            hi4pi_spectral = SpectralAxis(hdul[0].header)
+        w1, w2 = wallaby_spectral.channel_range(vmin, vmax, frame=args.velocity_frame, ra=ra, dec=dec)
+        s1, s2 = hi4pi_spectral.channel_range(vmin, vmax, frame=args.velocity_frame, ra=ra, dec=dec)
+        # HI4PI channels are decimated by imsub incr=1,1,2 before the channel selection
+        args.imsub_wallaby_channels = f'{w1},{w2}'
+        args.imsub_hi4pi_channels = f'{(s1 + 1) // 2},{min(-(-(s2 + 1) // 2), (hi4pi_spectral.naxis + 1) // 2)}'
+        logging.info(f'Channel ranges for {vmin} to {vmax} km/s ({args.velocity_frame}): WALLABY ({args.imsub_wallaby_channels}), HI4PI ({args.imsub_hi4pi_channels})')
+
+    region_str = args.imsub_region
+    hi4pi_region_str = f'images({args.imsub_hi4pi_channels})'
+    if args.imsub_region is None:
+        region = footprint.box_region(args.size, origin=1)
+        logging.info(f'WALLABY spatial region: {region}')
+        region_str = ','.join(map(str, region))
+    if args.hi4pi_region:
+        with fits.open(args.singledish) as hdul:
+            size = None if args.imsub_region is not None else args.size
+            sd_region = footprint.cutout_region(hdul[0].header, size=size, origin=1)
+        logging.info(f'HI4PI spatial region: {sd_region}')
+        hi4pi_region_str = f"boxes({','.join(map(str, sd_region))})({args.imsub_hi4pi_channels})"
+
+    # Intermediate miriad datasets
+    datadir = workdir
+    if args.scratch is not None:
+        datadir = args.scratch
+        logging.info(f'Writing intermediate miriad datasets to scratch: {datadir}')
 
     # Generate bash script
     logging.info(f'Creating miriad script: {args.filename}')
     with open(args.filename, 'w') as f:
         f.writelines('#!/bin/csh\n')
         f.writelines('miriad\n')
+        if args.scratch is not None:
+            f.writelines(f'mkdir -p {datadir}\n')
 
         # Reading files
-        f.writelines(f'fits in={args.singledish} op=xyin out={os.path.join(workdir, "sd")}\n')
-        f.writelines(f'fits in={args.wallaby} op=xyin out={os.path.join(workdir, "wallaby")}\n')
+        f.writelines(f'fits in={args.singledish} op=xyin out={os.path.join(datadir, "sd")}\n')
+        f.writelines(f'fits in={args.wallaby} op=xyin out={os.path.join(datadir, "wallaby")}\n')
 
         # Preprocess single dish data
-        f.writelines(f'hanning in={os.path.join(workdir, "sd")} out={os.path.join(workdir, "sd_hann")}\n')
-        f.writelines(f'imsub in={os.path.join(workdir, "sd_hann")} out={os.path.join(workdir, "sd_imsub_incr")} incr=1,1,2\n')
-        f.writelines(f'imsub in={os.path.join(workdir, "sd_imsub_incr")} out={os.path.join(workdir, "sd_imsub")} "region=images({args.imsub_hi4pi_channels})"\n')
+        f.writelines(f'hanning in={os.path.join(datadir, "sd")} out={os.path.join(datadir, "sd_hann")}\n')
+        f.writelines(f'imsub in={os.path.join(datadir, "sd_hann")} out={os.path.join(datadir, "sd_imsub_incr")} incr=1,1,2\n')
+        f.writelines(f'imsub in={os.path.join(datadir, "sd_imsub_incr")} out={os.path.join(datadir, "sd_imsub")} "region={hi4pi_region_str}"\n')
 
         # Preprocess WALLABY Milky Way observation
-        f.writelines(f'velsw in={os.path.join(workdir, "wallaby")} axis=freq options=altspc\n')
-        f.writelines(f'velsw in={os.path.join(workdir, "wallaby")} axis=freq,lsrk\n')
-        f.writelines(f'imsub in={os.path.join(workdir, "wallaby")} out={os.path.join(workdir, "wallaby_trim")} "region=boxes({region_str})({args.imsub_wallaby_channels})"\n')
+        f.writelines(f'velsw in={os.path.join(datadir, "wallaby")} axis=freq options=altspc\n')
+        f.writelines(f'velsw in={os.path.join(datadir, "wallaby")} axis=freq,lsrk\n')
+        f.writelines(f'imsub in={os.path.join(datadir, "wallaby")} out={os.path.join(datadir, "wallaby_trim")} "region=boxes({region_str})({args.imsub_wallaby_channels})"\n')
 
         # Regrid and merge
-        f.writelines(f'regrid in={os.path.join(workdir, "sd_imsub")} tin={os.path.join(workdir, "wallaby_trim")} out={os.path.join(workdir, "sd_regrid")}\n')
-        f.writelines(f'immerge in={os.path.join(workdir, "wallaby_trim")},{os.path.join(workdir, "sd_regrid")} out={os.path.join(workdir, "combined")} uvrange={args.immerge_uvrange} options=notaper\n')
-        f.writelines(f'fits in={os.path.join(workdir, "combined")} op=xyout out={args.output}\n')
+        f.writelines(f'regrid in={os.path.join(datadir, "sd_imsub")} tin={os.path.join(datadir, "wallaby_trim")} out={os.path.join(datadir, "sd_regrid")}\n')
+        f.writelines(f'immerge in={os.path.join(datadir, "wallaby_trim")},{os.path.join(datadir, "sd_regrid")} out={os.path.join(datadir, "combined")} uvrange={args.immerge_uvrange} options=notaper\n')
+        xyout = f'fits in={os.path.join(datadir, "combined")} op=xyout out={args.output}'
+
+        # Remove intermediate datasets only if this run wrote the combined output
+        # (a stale output from a previous run makes the fits task fail)
+        if args.cleanup:
+            datasets = ' '.join([os.path.join(datadir, d) for d in TRANSIENT_DATASETS])
+            xyout = f'{xyout} && test -s {args.output} && rm -rf {datasets}'
+        f.writelines(f'{xyout}\n')
 
     logging.info('Changing permissons (+x)')
     os.chmod(args.filename, 0o700)
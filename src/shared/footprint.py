@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""
+Sky footprint of a WALLABY observation and the pixel regions derived from it.
+A single celestial WCS is built per image and all boundary points of a region are
+transformed in one batched call.
+"""
+
+import math
+import numpy as np
+from astropy.wcs import WCS
+
+
+class Footprint(object):
+    """Celestial footprint of an image cube
+
+    """
+    def __init__(self, header):
+        self.header = header
+        self.wcs = WCS(header).celestial
+        self.nx = header['NAXIS1']
+        self.ny = header['NAXIS2']
+
+    def centre(self):
+        """World coordinates (ra, dec) [deg] of the central pixel
+
+        """
+        ra, dec = self.wcs.all_pix2world([self.nx // 2], [self.ny // 2], 0)
+        return float(ra[0]), float(dec[0])
+
+    def box_points(self, size, n=3):
+        """World coordinates of n x n points (corners, edges and centre for n=3) on a
+        box of width and height size [arcmin] centred on the image centre.
+        RA offsets are scaled by cos(dec) of each point and wrapped to [0, 360).
+
+        """
+        ra0, dec0 = self.centre()
+        half = size / 2.0 / 60.0
+        offsets = np.linspace(-half, half, n)
+        dx, dy = np.meshgrid(offsets, offsets)
+        dec = np.clip(dec0 + dy.ravel(), -90.0, 90.0)
+        cos_dec = np.maximum(np.cos(np.radians(dec)), 1e-6)
+        ra = np.mod(ra0 + dx.ravel() / cos_dec, 360.0)
+        return ra, dec
+
+    def edge_points(self, n=16):
+        """World coordinates of n points along each edge of the image
+
+        """
+        x = np.linspace(-0.5, self.nx - 0.5, n)
+        y = np.linspace(-0.5, self.ny - 0.5, n)
+        px = np.concatenate([x, x, np.full(n, -0.5), np.full(n, self.nx - 0.5)])
+        py = np.concatenate([np.full(n, -0.5), np.full(n, self.ny - 0.5), y, y])
+        return self.wcs.all_pix2world(px, py, 0)
+
+    @staticmethod
+    def _bounds(px, py, nx, ny, pad=0, origin=0):
+        x_min = max(int(math.floor(np.nanmin(px))) - pad, 0)
+        y_min = max(int(math.floor(np.nanmin(py))) - pad, 0)
+        x_max = min(int(math.ceil(np.nanmax(px))) + pad, nx - 1)
+        y_max = min(int(math.ceil(np.nanmax(py))) + pad, ny - 1)
+        return x_min + origin, y_min + origin, x_max + origin, y_max + origin
+
+    def box_region(self, size, origin=0):
+        """Pixel region (x_min, y_min, x_max, y_max) of a box of width and height size [arcmin]
+        centred on the image, clipped to the image bounds.
+
+        """
+        ra, dec = self.box_points(size)
+        px, py = self.wcs.all_world2pix(ra, dec, 0)
+        return self._bounds(px, py, self.nx, self.ny, origin=origin)
+
+    def cutout_region(self, header, size=None, pad=2, origin=0):
+        """Pixel region (x_min, y_min, x_max, y_max) of another image (e.g. HI4PI) covering this
+        footprint, or a box of width and height size [arcmin] if provided, padded by pad pixels.
+
+        """
+        other = WCS(header).celestial
+        if size is None:
+            ra, dec = self.edge_points()
+        else:
+            ra, dec = self.box_points(size)
+        px, py = other.all_world2pix(ra, dec, 0)
+        return self._bounds(px, py, header['NAXIS1'], header['NAXIS2'], pad=pad, origin=origin)
+
+    def tiles(self, nx_tiles, ny_tiles, overlap=0, region=None):
+        """Split the image, or a pixel region (x_min, y_min, x_max, y_max) of it, into a grid of
+        tiles overlapping by overlap pixels (0-based, e.g. for SoFiA input.region).
+        Returns a list of (x_min, y_min, x_max, y_max).
+
+        """
+        def split(lo, hi, n):
+            edges = np.linspace(lo, hi + 1, n + 1).round().astype(int)
+            return [(max(int(a) - overlap, lo), min(int(b) - 1 + overlap, hi)) for a, b in zip(edges[:-1], edges[1:])]
+
+        if region is None:
+            region = (0, 0, self.nx - 1, self.ny - 1)
+        x_min, y_min, x_max, y_max = region
+        return [
+            (x1, y1, x2, y2)
+            for (y1, y2) in split(y_min, y_max, ny_tiles)
+            for (x1, x2) in split(x_min, x_max, nx_tiles)
+        ]
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+"""
+Spectral axis utilities for WALLABY Milky Way and HI4PI cubes.
+Vectorised conversion between channel, frequency and radio/optical/relativistic velocity for
+FREQ, VRAD, VOPT, FELO and VELO spectral axes, with reference frame conversion
+through astropy SpectralCoord.
+"""
+
+import numpy as np
+
+
+FHI = 1.42040575e+9
+SOL = 299792.458
+SPECTRAL_TYPES = ['FREQ', 'VRAD', 'VOPT', 'FELO', 'VELO']
+# Upper case unit strings written by older software that astropy does not parse
+LEGACY_UNITS = {'HZ': 'Hz', 'KHZ': 'kHz', 'MHZ': 'MHz', 'GHZ': 'GHz', 'M/S': 'm/s', 'KM/S': 'km/s'}
+FRAMES = {
+    'BARYCENT': 'icrs',
+    'HELIOCEN': 'hcrs',
+    'LSRK': 'lsrk',
+    'LSRD': 'lsrd',
+    'GALACTOC': 'galactocentric'
+}
+
+
+def velocity_to_frequency(velocity, convention='radio', restfreq=FHI):
+    """Convert velocity [km/s] to frequency [Hz] for the radio, optical or relativistic convention
+
+    """
+    velocity = np.asarray(velocity, dtype=float)
+    if convention == 'radio':
+        return restfreq * (1.0 - velocity / SOL)
+    if convention == 'optical':
+        return restfreq / (1.0 + velocity / SOL)
+    if convention == 'relativistic':
+        return restfreq * np.sqrt((SOL - velocity) / (SOL + velocity))
+    raise ValueError(f'Unknown velocity convention: {convention}')
+
+
+def frequency_to_velocity(frequency, convention='radio', restfreq=FHI):
+    """Convert frequency [Hz] to velocity [km/s] for the radio, optical or relativistic convention
+
+    """
+    frequency = np.asarray(frequency, dtype=float)
+    if convention == 'radio':
+        return SOL * (1.0 - frequency / restfreq)
+    if convention == 'optical':
+        return SOL * (restfreq / frequency - 1.0)
+    if convention == 'relativistic':
+        return SOL * (restfreq ** 2 - frequency ** 2) / (restfreq ** 2 + frequency ** 2)
+    raise ValueError(f'Unknown velocity convention: {convention}')
+
+
+def convert_frame(frequency, ra, dec, from_frame, to_frame, obstime=None, location=None):
+    """Convert frequencies [Hz] observed towards (ra, dec) [deg] between spectral reference frames
+    (FITS SPECSYS values, e.g. BARYCENT, LSRK, TOPOCENT).
+
+    """
+    frequency = np.asarray(frequency, dtype=float)
+    if from_frame == to_frame:
+        return frequency
+
+    import astropy.units as u
+    from astropy.coordinates import SkyCoord, SpectralCoord, ICRS, CartesianRepresentation, CartesianDifferential
+
+    target = SkyCoord(
+        ra=ra * u.deg, dec=dec * u.deg, distance=1 * u.kpc,
+        pm_ra_cosdec=0 * u.mas / u.yr, pm_dec=0 * u.mas / u.yr, radial_velocity=0 * u.km / u.s, frame='icrs'
+    )
+
+    def observer(frame):
+        if frame == 'TOPOCENT':
+            if obstime is None or location is None:
+                raise ValueError('TOPOCENT spectral frame requires obstime and location')
+            return location.get_itrs(obstime=obstime)
+        if frame not in FRAMES:
+            raise ValueError(f'Unsupported spectral reference frame: {frame}')
+        origin = ICRS(CartesianRepresentation(
+            [0, 0, 0] * u.km, differentials=CartesianDifferential([0, 0, 0] * u.km / u.s)
+        ))
+        if frame == 'BARYCENT':
+            return origin
+        return SpectralCoord(1.0 * u.Hz, observer=origin, target=target).with_observer_stationary_relative_to(FRAMES[frame]).observer
+
+    sc = SpectralCoord(frequency * u.Hz, observer=observer(from_frame), target=target)
+    if to_frame == 'TOPOCENT':
+        sc = sc.with_observer_stationary_relative_to(observer(to_frame))
+    else:
+        sc = sc.with_observer_stationary_relative_to(FRAMES.get(to_frame, to_frame))
+    return sc.to_value(u.Hz)
+
+
+class SpectralAxis(object):
+    """Linear spectral axis of a FITS cube
+
+    """
+    def __init__(self, header):
+        self.axis = None
+        for i in range(1, header['NAXIS'] + 1):
+            ctype = str(header.get(f'CTYPE{i}', ''))
+            if ctype.split('-')[0] in SPECTRAL_TYPES:
+                self.axis = i
+                break
+        if self.axis is None:
+            raise Exception(f'No spectral axis ({", ".join(SPECTRAL_TYPES)}) found in header')
+
+        self.ctype = header[f'CTYPE{self.axis}'].split('-')[0]
+        self.crval = float(header[f'CRVAL{self.axis}'])
+        self.cdelt = self._cdelt(header)
+        self.crpix = float(header[f'CRPIX{self.axis}'])
+        self.naxis = int(header[f'NAXIS{self.axis}'])
+        self.restfreq = float(header.get('RESTFRQ', header.get('RESTFREQ', FHI)))
+        self.specsys = str(header.get('SPECSYS', '')).strip()
+        if self.specsys not in FRAMES and self.specsys != 'TOPOCENT':
+            self.specsys = 'LSRK' if 'LSR' in str(header[f'CTYPE{self.axis}']) else 'BARYCENT'
+        self.convention = self._convention(header)
+        unit = str(header.get(f'CUNIT{self.axis}', '')).strip() or ('Hz' if self.ctype == 'FREQ' else 'm/s')
+        self.scale = self._scale(unit)
+
+    def _cdelt(self, header):
+        """Pixel increment of the axis. CDELTi scaled by PCi_i, or CDi_i if there is no CDELTi.
+
+        """
+        i = self.axis
+        if f'CDELT{i}' not in header and f'CD{i}_{i}' in header:
+            return float(header[f'CD{i}_{i}'])
+        return float(header.get(f'CDELT{i}', 1.0)) * float(header.get(f'PC{i}_{i}', 1.0))
+
+    def _scale(self, unit):
+        """Factor converting axis values in unit to Hz (FREQ) or km/s (velocity axes)
+
+        """
+        import astropy.units as u
+
+        target = u.Hz if self.ctype == 'FREQ' else u.km / u.s
+        try:
+            return float(u.Unit(LEGACY_UNITS.get(unit, unit)).to(target))
+        except (ValueError, u.UnitsError):
+            raise ValueError(f'Unsupported unit {unit} for {self.ctype} spectral axis (expected {target})')
+
+    def _convention(self, header):
+        """Velocity convention of the axis. VELO is relativistic in FITS WCS Paper III, while the
+        AIPS VELO-LSR/VELO-HEL/VELO-OBS convention is radio or optical depending on VELREF.
+
+        """
+        if self.ctype in ['FREQ', 'VRAD']:
+            return 'radio'
+        if self.ctype in ['VOPT', 'FELO']:
+            return 'optical'
+        ctype = str(header[f'CTYPE{self.axis}']).strip()
+        if ctype in ['VELO-LSR', 'VELO-HEL', 'VELO-OBS']:
+            if 'VELREF' not in header:
+                raise ValueError(f'Cannot determine velocity convention of {ctype} axis without VELREF')
+            return 'radio' if int(header['VELREF']) > 256 else 'optical'
+        return 'relativistic'
+
+    def world(self, pixel):
+        """Native axis value (Hz or km/s) for 1-based FITS pixel coordinates
+
+        """
+        pixel = np.asarray(pixel, dtype=float)
+        return (self.crval + (pixel - self.crpix) * self.cdelt) * self.scale
+
+    def pixel(self, world):
+        """1-based FITS pixel coordinates for native axis values (Hz or km/s)
+
+        """
+        world = np.asarray(world, dtype=float) / self.scale
+        return (world - self.crval) / self.cdelt + self.crpix
+
+    def frequency(self, pixel):
+        """Frequency [Hz] of 1-based FITS pixel coordinates
+
+        """
+        value = self.world(pixel)
+        if self.ctype == 'FREQ':
+            return value
+        return velocity_to_frequency(value, self.convention, self.restfreq)
+
+    def pixel_from_frequency(self, frequency):
+        """1-based FITS pixel coordinates of frequencies [Hz] in the frame of the axis
+
+        """
+        frequency = np.asarray(frequency, dtype=float)
+        if self.ctype == 'FREQ':
+            return self.pixel(frequency)
+        return self.pixel(frequency_to_velocity(frequency, self.convention, self.restfreq))
+
+    def pixel_from_velocity(self, velocity, convention='radio', frame=None, ra=None, dec=None, **kwargs):
+        """1-based FITS pixel coordinates of velocities [km/s] in a given reference frame
+        (defaults to the frame of the axis). Direction (ra, dec) [deg] required for frame conversion.
+
+        """
+        frequency = velocity_to_frequency(velocity, convention, self.restfreq)
+        if frame is not None and frame != self.specsys:
+            frequency = convert_frame(frequency, ra, dec, frame, self.specsys, **kwargs)
+        return self.pixel_from_frequency(frequency)
+
+    def channel_range(self, vmin, vmax, convention='radio', frame=None, ra=None, dec=None, **kwargs):
+        """Inclusive 1-based channel range covering a velocity window [km/s], clipped to the cube
+
+        """
+        pixels = self.pixel_from_velocity([vmin, vmax], convention, frame, ra, dec, **kwargs)
+        c1 = max(int(np.floor(np.min(pixels))), 1)
+        c2 = min(int(np.ceil(np.max(pixels))), self.naxis)
+        if c2 < c1:
+            raise ValueError(f'Velocity window ({vmin}, {vmax}) km/s is outside of the spectral axis')
+        return c1, c2
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+"""Spectral slab planner for SoFiA-2 source finding.
+
+Divides the channel axis of the cube either side of the Milky Way velocity range
+into slabs that fit within a session memory budget. Adjacent slabs overlap by the
+width of the largest spectral smoothing kernel so that sources at slab boundaries
+are smoothed and detected the same as they would be in the full cube.
+"""
+
+import math
+import logging
+
+
+# Approximate SoFiA-2 peak memory as a multiple of the input data size
+# (data cube, mask, smoothed copy and noise-normalised cube).
+SOFIA_MEMORY_FACTOR = 4.0
+DEFAULT_KERNELS_Z = '0, 3, 7, 15'
+DEFAULT_KERNELS_XY = '0, 3, 6'
+
+# RAM [GB] options accepted by the Skaha session API
+SESSION_RAM_OPTIONS = [1, 2, 4, 8, 16, 32, 64, 128, 192]
+
+
+def parse_kernels(value):
+    """Parse a SoFiA kernel list parameter (e.g. '0, 3, 7, 15') into a list of ints
+
+    """
+    if value is None or not value.strip():
+        return []
+    return [int(k) for k in value.replace(' ', '').split(',') if k]
+
+
+def spectral_overlap(parameters):
+    """Channel overlap required between slabs for a SoFiA parameter file template.
+    Set by the widest spectral kernel of the smooth + clip finder or the smoothing filter.
+
+    """
+    kernels = parse_kernels(parameters.get('scfind.kernelsZ', DEFAULT_KERNELS_Z))
+    if parameters.get('smooth.enable', 'false').lower() == 'true':
+        kernels += parse_kernels(parameters.get('smooth.kernelZ', '0'))
+    return max(kernels + [0])
+
+
+def spatial_overlap(parameters):
+    """Pixel overlap required between spatial tiles for a SoFiA parameter file template.
+    Set by the widest spatial kernel of the smooth + clip finder or the smoothing filter.
+
+    """
+    kernels = parse_kernels(parameters.get('scfind.kernelsXY', DEFAULT_KERNELS_XY))
+    if parameters.get('smooth.enable', 'false').lower() == 'true':
+        kernels += parse_kernels(parameters.get('smooth.kernelXY', '0'))
+    return max(kernels + [0])
+
+
+def max_channels_for_memory(nx, ny, bitpix, ram, factor=SOFIA_MEMORY_FACTOR):
+    """Maximum number of channels per slab for a given session RAM budget [GB]
+
+    """
+    bytes_per_channel = nx * ny * (abs(int(bitpix)) // 8) * factor
+    return max(int(ram * 1024 ** 3 // bytes_per_channel), 1)
+
+
+def ram_option(ram):
+    """Largest Skaha RAM option [GB] not exceeding ram
+
+    """
+    options = [r for r in SESSION_RAM_OPTIONS if r <= ram]
+    if not options:
+        raise ValueError(f'RAM budget of {ram} GB is below the smallest session RAM option ({SESSION_RAM_OPTIONS[0]} GB)')
+    return options[-1]
+
+
+def slab_memory(nx, ny, bitpix, nchan, maximum=None, factor=SOFIA_MEMORY_FACTOR, minimum=4):
+    """Session RAM [GB] required to run SoFiA-2 on a slab of nchan channels, rounded up to the
+    next Skaha RAM option and no higher than maximum [GB]
+
+    """
+    nbytes = nx * ny * nchan * (abs(int(bitpix)) // 8) * factor
+    required = max(nbytes / 1024 ** 3, minimum)
+    options = SESSION_RAM_OPTIONS
+    if maximum is not None:
+        options = [r for r in options if r <= ram_option(maximum)]
+    return next((r for r in options if r >= required), options[-1])
+
+
+def split_range(z_min, z_max, max_channels, overlap=0, min_slabs=1):
+    """Split an inclusive channel range into evenly sized overlapping slabs.
+    Returns a list of inclusive (z_min, z_max) tuples.
+
+    """
+    if z_max < z_min:
+        return []
+    nchan = z_max - z_min + 1
+    if max_channels <= overlap:
+        raise ValueError(f'Slab size ({max_channels} channels) must exceed the slab overlap ({overlap} channels)')
+
+    n_slabs = max(math.ceil((nchan - overlap) / (max_channels - overlap)), min_slabs, 1)
+    n_slabs = min(n_slabs, nchan)
+    width = math.ceil((nchan + (n_slabs - 1) * overlap) / n_slabs)
+
+    slabs = []
+    start = z_min
+    while True:
+        end = min(start + width - 1, z_max)
+        slabs.append((start, end))
+        if end >= z_max:
+            break
+        start = max(end - overlap + 1, start + 1)
+    if len(slabs) < min_slabs:
+        logging.warning(f'Channels {z_min}-{z_max} split into {len(slabs)} slabs, fewer than the {min_slabs} requested, with {overlap} channels overlap')
+    return slabs
+
+
+def plan_slabs(nchan, fpix1, fpix2, max_channels, overlap=0, min_slabs=1):
+    """Plan source finding slabs for the negative and positive velocity ranges either side
+    of the Milky Way emission channels (fpix1, fpix2, 1-based FITS pixels). Returns a dictionary
+    of velocity range ('neg', 'pos') to a list of inclusive 0-based channel ranges (SoFiA input.region).
+
+    """
+    last = nchan - 1
+    neg = (max(fpix1 - 1, 0), last)
+    pos = (0, min(fpix2 - 1, last))
+    return {
+        'neg': split_range(*neg, max_channels, overlap, min_slabs),
+        'pos': split_range(*pos, max_channels, overlap, min_slabs)
+    }
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+"""SoFiA-2 parameter file model.
+
+The template is parsed once into its original lines plus an ordered index of
+parameter keys to line numbers. Variants are rendered by overriding values for
+a set of keys, so many parameter files (e.g. one per tile or velocity slab) can
+be produced in-process from a single parse of the template.
+"""
+
+import os
+import tempfile
+
+
+def atomic_write(filename, content):
+    """Write content to a temporary file in the destination directory then rename it into place.
+    The file is given the default (umask) permissions rather than the 0600 of mkstemp.
+
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, filename)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return filename
+
+
+class ParameterFile(object):
+    """Parsed SoFiA-2 parameter file
+
+    """
+    def __init__(self, lines):
+        self.lines = [line.rstrip('\n') for line in lines]
+        self.index = {}
+        for i, line in enumerate(self.lines):
+            key = self._parse_key(line)
+            if key is not None:
+                self.index[key] = i
+
+    @staticmethod
+    def _parse_key(line):
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#') or '=' not in stripped:
+            return None
+        return stripped.split('=', 1)[0].strip()
+
+    @classmethod
+    def from_file(cls, filename):
+        with open(filename, 'r') as f:
+            return cls(f.readlines())
+
+    @classmethod
+    def from_string(cls, content):
+        return cls(content.splitlines())
+
+    def keys(self):
+        return list(self.index.keys())
+
+    def get(self, key, default=None):
+        """Return the value of a parameter in the template
+
+        """
+        if key not in self.index:
+            return default
+        return self.lines[self.index[key]].split('=', 1)[1].strip()
+
+    def render(self, overrides=None):
+        """Render the parameter file content with values replaced by overrides.
+        Parameters not present in the template are appended to the end of the file.
+
+        """
+        overrides = overrides or {}
+        lines = list(self.lines)
+        extra = []
+        for key, value in overrides.items():
+            line = f'{key} = {value}'
+            if key in self.index:
+                lines[self.index[key]] = line
+            else:
+                extra.append(line)
+        return '\n'.join(lines + extra) + '\n'
+
+    def write(self, filename, overrides=None):
+        """Atomically write a rendered parameter file
+
+        """
+        return atomic_write(filename, self.render(overrides))
+
+    def write_variants(self, variants):
+        """Write a parameter file for each variant.
+        Variants is a dictionary of output filename to parameter overrides.
+
+        """
+        return [self.write(filename, overrides) for filename, overrides in variants.items()]
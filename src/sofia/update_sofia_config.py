@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
 """Custom method to update the SoFiA-2 parameter files for WALLABY Milky Way + SD joint source finding
-Will create two separate parameter files for the positive and negative velocity ranges.
+Will create parameter files for spectral slabs of the positive and negative velocity ranges,
+sized to fit the session memory budget, and a JSON manifest of the slabs for the pipeline.
 
 Velocity range calculation:
 This script takes a position in J2000 equatorial coordinates
@@ -15,13 +16,13 @@ Compilation: gcc -O3 -o velo_range velo_range.c -lm
 import os
 import sys
 import math
+import json
 import numpy as np
 import logging
-from astropy.io import fits
-from astropy.wcs import WCS
-import astropy.units as u
-from astropy.coordinates import SkyCoord
 from argparse import ArgumentParser
+from spectral import SpectralAxis
+from sofia_parameters import ParameterFile, atomic_write
+from slabs import spectral_overlap, spatial_overlap, max_channels_for_memory, plan_slabs, slab_memory, ram_option
 
 
 logging.basicConfig(level=logging.INFO)
@@ -35,29 +36,11 @@ FHI = 1.42040575e+9
 SOL = 299792.458
 
 
-def get_centre(hdu):
-    w = WCS(hdu.header)
-    c_ra_pix = hdu.header['NAXIS1'] // 2
-    c_dec_pix = hdu.header['NAXIS2'] // 2
-    centre = SkyCoord.from_pixel(c_ra_pix, c_dec_pix, wcs=w)
-    return centre
-
-
 def pixel_from_frequency(hdu, freq):
-    header = hdu.header
-    if header['CTYPE3'] == 'FREQ':
-        crval = header['CRVAL3']
-        cdelt = header['CDELT3']
-        crpix = header['CRPIX3']
-    elif header['CTYPE4'] == 'FREQ':
-        crval = header['CRVAL4']
-        cdelt = header['CDELT4']
-        crpix = header['CRPIX4']
-    else:
-        raise Exception('CTYPE3 and CTYPE4 are not frequency axes...')
+    """1-based pixel coordinate(s) of frequencies [Hz] along the spectral axis of the cube
 
-    pixel = (freq - crval) / cdelt + crpix
-    return pixel
+    """
+    return SpectralAxis(hdu.header).pixel_from_frequency(freq)
 
 
 def rotation_curve(r):
@@ -175,6 +158,10 @@ def main(argv):
     parser.add_argument('-no', '--negative_output_filename', default='negative', required=False, help='Parameter filename for negative velocity range')
     parser.add_argument('-d', '--input_data', required=True, help='Parameter: input.data')
     parser.add_argument('-od', '--output_directory', required=True, help='Parameter: output.directory')
+    parser.add_argument('-r', '--ram', type=float, default=32.0, required=False, help='Maximum RAM [GB] per SoFiA session')
+    parser.add_argument('-s', '--slabs', type=int, default=1, required=False, help='Minimum number of slabs per velocity range')
+    parser.add_argument('-t', '--tiles', default='1,1', required=False, help='Number of spatial tiles nx,ny per slab')
+    parser.add_argument('-m', '--manifest', default='slabs.json', required=False, help='Slab manifest filename (written to the parameter file directory)')
     args = parser.parse_args(argv)
 
     assert os.path.exists(args.image), 'Fits image does not exist'
@@ -185,12 +172,14 @@ def main(argv):
     assert os.path.exists(args.output_directory), 'Output directory for SoFiA output products'
 
     # Open image cube
+    from astropy.io import fits
+    from footprint import Footprint
+
     with fits.open(args.image) as hdul:
         hdu = hdul[0]
-        centre = get_centre(hdu)
-    logging.info(f'Image centre: {centre}')
-    ra = centre.ra.value
-    dec = centre.dec.value
+        footprint = Footprint(hdu.header)
+    ra, dec = footprint.centre()
+    logging.info(f'Image centre: ({ra}, {dec})')
 
     # Get milkyway frequency range
     v1, v2 = velocity_range(ra, dec)
@@ -205,42 +194,66 @@ def main(argv):
 
     # Reading parameter file
     logging.info('Reading parameter file template')
-    with open(args.input_parameter_file, 'r') as fi:
-        parameters = fi.readlines()
+    template = ParameterFile.from_file(args.input_parameter_file)
+
+    # Plan spatial tiles and spectral slabs
+    header = hdu.header
+    nx_tiles, ny_tiles = [int(n) for n in args.tiles.split(',')]
+    tiles = footprint.tiles(nx_tiles, ny_tiles, overlap=spatial_overlap(template))
+    tile_nx = max(x2 - x1 + 1 for x1, _, x2, _ in tiles)
+    tile_ny = max(y2 - y1 + 1 for _, y1, _, y2 in tiles)
+    logging.info(f'Spatial tiles: {tiles}')
+    nchan = SpectralAxis(header).naxis
+    overlap = spectral_overlap(template)
+    max_channels = max_channels_for_memory(tile_nx, tile_ny, header['BITPIX'], ram_option(args.ram))
+    if max_channels <= overlap:
+        raise ValueError(
+            f'RAM budget of {args.ram} GB per session fits {max_channels} channels, which does not exceed '
+            f'the {overlap} channel slab overlap. Increase --ram, use more tiles or reduce the spectral kernels.'
+        )
+    plan = plan_slabs(nchan, fpix1, fpix2, max_channels, overlap, args.slabs)
+    logging.info(f'Slab plan (overlap {overlap} channels, max {max_channels} channels per slab): {plan}')
 
     # Update content
-    update_dict_neg = {
+    common = {
         'input.data': args.input_data,
-        'input.region': f'0,99999,0,99999,{fpix1},99999',
-        'output.directory': args.output_directory,
-        'output.filename': args.negative_output_filename
+        'output.directory': args.output_directory
     }
-    update_dict_pos = {
-        'input.data': args.input_data,
-        'input.region': f'0,99999,0,99999,0,{fpix2}',
-        'output.directory': args.output_directory,
-        'output.filename': args.positive_output_filename
+    names = {
+        'neg': (args.negative_filename, args.negative_output_filename),
+        'pos': (args.positive_filename, args.positive_output_filename)
     }
+    variants = {}
+    manifest = []
+    for sign, slabs in plan.items():
+        parameter_filename, output_filename = names[sign]
+        prefix, ext = os.path.splitext(parameter_filename)
+        for i, (z_min, z_max) in enumerate(slabs):
+            for j, (x_min, y_min, x_max, y_max) in enumerate(tiles):
+                suffix = f'{i:03d}' if len(tiles) == 1 else f'{i:03d}_t{j:03d}'
+                filename = os.path.join(args.output_parameter_files, f'{prefix}_{suffix}{ext}')
+                region = f'{x_min},{x_max},{y_min},{y_max},{z_min},{z_max}'
+                variants[filename] = {
+                    **common,
+                    'input.region': region,
+                    'output.filename': f'{output_filename}_{suffix}'
+                }
+                manifest.append({
+                    'name': f"{sign}-{suffix.replace('_', '-')}",
+                    'parameter_file': filename,
+                    'region': region,
+                    'channels': [z_min, z_max],
+                    'ram': slab_memory(x_max - x_min + 1, y_max - y_min + 1, header['BITPIX'], z_max - z_min + 1, maximum=args.ram)
+                })
 
     # Writing to parameter files
     logging.info('Writing output parameter files')
-    pos = os.path.join(args.output_parameter_files, args.positive_filename)
-    logging.info(f'Writing {pos}')
-    with open(pos, 'w') as fo:
-        for line in parameters:
-            param = line.split('=')[0].strip()
-            if param in update_dict_pos.keys():
-                line = f'{param} = {update_dict_pos[param]}\n'
-            fo.write(line)
-
-    neg = os.path.join(args.output_parameter_files, args.negative_filename)
-    logging.info(f'Writing {neg}')
-    with open(neg, 'w') as fo:
-        for line in parameters:
-            param = line.split('=')[0].strip()
-            if param in update_dict_neg.keys():
-                line = f'{param} = {update_dict_neg[param]}\n'
-            fo.write(line)
+    for filename in template.write_variants(variants):
+        logging.info(f'Wrote {filename}')
+
+    manifest_file = os.path.join(args.output_parameter_files, args.manifest)
+    logging.info(f'Writing slab manifest {manifest_file}')
+    atomic_write(manifest_file, json.dumps(manifest, indent=2))
 
     logging.info('Writing updated parameter files complete')
 